@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+""" Fails when importing build.py or the resolver takes longer than the startup budget """
+
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BUDGET_MS = int(os.environ.get("STARTUP_BUDGET_MS", 250))
+MODULES = ["build", "builder.arch.resolver"]
+
+
+def import_time_ms(module: str) -> float:
+    """ Cumulative import time of a module in a fresh interpreter, from -X importtime """
+    ret = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                         cwd=ROOT, capture_output=True, text=True, check=True)
+    for line in ret.stderr.split("\n"):
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1000
+    raise RuntimeError(f"No import time reported for {module}")
+
+
+if __name__ == "__main__":
+    failed = False
+    for module in MODULES:
+        ms = min(import_time_ms(module) for _ in range(5))
+        status = "ok" if ms <= BUDGET_MS else "over budget"
+        print(f"{module}: {ms:.1f}ms ({status}, budget {BUDGET_MS}ms)")
+        failed = failed or ms > BUDGET_MS
+    sys.exit(1 if failed else 0)
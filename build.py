@@ -1,4 +1,5 @@
 #!/usr/bin/env -S python -u
+from __future__ import annotations
 
 import csv
 import json
@@ -6,21 +7,28 @@ import os
 import pathlib
 import shutil
 import sys
+from functools import cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from queue import Queue
 from tempfile import NamedTemporaryFile
-from typing import Optional
+from threading import Event, Lock, Thread
+from typing import Callable, Optional, TYPE_CHECKING
 
-from git.repo import Repo
 from loguru import logger
 
-from builder.arch import resolver, pkgbuild
-from builder.arch.pkgbuild import PkgBuildPackage
-from builder.arch.repository import Repository
-from builder.arch.repository_search import LocalPackage, AURPackage
-from builder.arch.resolver import Package
 from builder.util import system
+from builder.util.compiler_cache import CompilerCache
 from builder.util.s3repo import S3Repo
 
+# GitPython, pyalpm and the pydantic models are imported where they are used, so
+# short-lived --package and --render runs don't pay for them at startup
+if TYPE_CHECKING:
+    from git.repo import Repo
+
+    from builder.arch.pkgbuild import PkgBuildPackage
+    from builder.arch.resolver import Package
+
 MANIFEST_NAME = "manifest.csv"
 REPO_NAME = "aurei"
 BUCKET_NAME = "aurei.nulls.ec"
@@ -28,17 +36,33 @@ KEY_NAME = os.environ.get("KEY_NAME", "aurei.pgp")
 KEY_ID = os.environ.get("KEY_ID", "565ABC3363CDD9F1E333E5744AAFA429C6F28921")
 PACKAGER = os.environ.get("PACKAGER", "Aurei Builder <aurei@nulls.ec>")
 MAX_PER_BUILD = int(os.environ.get("MAX_PER_BUILD", 5))
+KEYSERVER = os.environ.get("KEYSERVER", "keyserver.ubuntu.com")
+KEYSERVER_TIMEOUT = int(os.environ.get("KEYSERVER_TIMEOUT", 120))
+KEY_REFRESH_DAYS = int(os.environ.get("KEY_REFRESH_DAYS", 7))
+KEYRING_DIR = os.environ.get("KEYRING_DIR") or None
+PACMAN_STAMP = os.environ.get("PACMAN_STAMP")
+PACMAN_CACHE_MAX_MB = int(os.environ.get("PACMAN_CACHE_MAX_MB", 0))
+COMPILER_CACHE = os.environ.get("COMPILER_CACHE")
+COMPILER_CACHE_DIR = os.environ.get("COMPILER_CACHE_DIR", os.path.expanduser("~/.cache/aurei"))
+COMPILER_CACHE_SIZE = os.environ.get("COMPILER_CACHE_SIZE", "2G")
+NOCACHE_NAME = "nocache.txt"
+PUBLISH_EVERY = int(os.environ.get("PUBLISH_EVERY", 1))
+SERVE_ADDRESS = os.environ.get("SERVE_ADDRESS", "127.0.0.1")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", 8080))
+SERVE_INTERVAL = int(os.environ.get("SERVE_INTERVAL", 300))
 
 class Manifest:
     """ Manifest file of latest package updates """
     HEADER = ['package', 'sha']
+    # The pipeline publisher updates the manifest from its own thread
+    lock = Lock()
 
     def __init__(self, filename: str):
         self.filename = filename
         Path(self.filename).touch()
 
     def check(self, package: str) -> Optional[str]:
-        with open(self.filename, 'r') as manifest:
+        with Manifest.lock, open(self.filename, 'r') as manifest:
             reader = csv.DictReader(manifest, Manifest.HEADER)
             for row in reader:
                 if row['package'].lower() == package.lower():
@@ -46,6 +70,10 @@ class Manifest:
             return None
 
     def update(self, package: str, sha: str) -> None:
+        with Manifest.lock:
+            self._update(package, sha)
+
+    def _update(self, package: str, sha: str) -> None:
         tempfile = NamedTemporaryFile(mode='w', delete=False)
         with open(self.filename, 'r') as manifest, tempfile:
             reader = csv.DictReader(manifest, fieldnames=Manifest.HEADER)
@@ -62,16 +90,47 @@ class Manifest:
         shutil.move(tempfile.name, self.filename)
 
 
-def makepkg_env() -> dict[str, str]:
+@cache
+def compiler_cache() -> Optional[CompilerCache]:
+    """ Created on first build so --package and --render don't need a valid COMPILER_CACHE """
+    if not COMPILER_CACHE:
+        return None
+    return CompilerCache(COMPILER_CACHE, COMPILER_CACHE_DIR, COMPILER_CACHE_SIZE, NOCACHE_NAME)
+
+
+def makepkg_env(pkgbase: str, cc: Optional[CompilerCache]) -> dict[str, str]:
     env = os.environ.copy()
     env["PKGDEST"] = "../../artifacts"
     env["PATH"] = "/usr/local/bin:/usr/local/sbin:/usr/bin"
     env["GPGKEY"] = KEY_ID
     env["PACKAGER"] = PACKAGER
+    if cc is not None:
+        cc.configure(pkgbase, env)
     return env
 
 
+def makepkg(args: list[str], pkgbase: str, cwd: str) -> None:
+    cc = compiler_cache()
+    if cc is not None and not cc.enabled(pkgbase):
+        cc = None
+    env = makepkg_env(pkgbase, cc)
+    if cc is not None:
+        cc.start(env)
+    try:
+        system.execute(['makepkg'] + args, env=env, cwd=cwd)
+        if cc is not None:
+            cc.report(pkgbase, env)
+    finally:
+        if cc is not None:
+            cc.stop(env)
+
+
 def process_dependency(path: str, package: Package, env_packages: list[PkgBuildPackage]) -> None:
+    from git.repo import Repo
+
+    from builder.arch import resolver, pkgbuild
+    from builder.arch.repository_search import LocalPackage, AURPackage
+
     logger.debug("Checking package dependencies")
     dependencies = resolver.resolve(
         list(map(lambda x: x["name"], package.depends)), env_packages)
@@ -84,9 +143,14 @@ def process_dependency(path: str, package: Package, env_packages: list[PkgBuildP
             pkg_root = os.path.join(path, '../')
             target_repo = os.path.join(pkg_root, dependency.package_base)
             if not os.path.exists(path=target_repo):
-                # Already done as part of this run?
                 Repo.clone_from(
                     f'https://aur.archlinux.org/{dependency.package_base}.git', target_repo)
+            elif os.path.isdir(os.path.join(target_repo, '.git')):
+                # Cloned by an earlier run or daemon cycle, submodules have a .git file instead and stay pinned
+                logger.debug(f"Updating aur clone of {dependency.package_base}")
+                clone = Repo(target_repo)
+                clone.git.fetch('origin')
+                clone.git.reset('--hard', 'origin/HEAD')
 
             pkgs = pkgbuild.parse(target_repo)
 
@@ -97,49 +161,182 @@ def process_dependency(path: str, package: Package, env_packages: list[PkgBuildP
                     logger.debug(f"SKIPPING {pkg.pkgname}")
                     continue
                 process_dependency(path, pkg, env_packages + [pkg])
-            system.execute(['makepkg', '-s', '-i', '-C', '--noconfirm', '--needed'], env=makepkg_env(),
-                           cwd=target_repo)
+            makepkg(['-s', '-i', '-C', '--noconfirm', '--needed'], dependency.package_base, target_repo)
+
 
+def process(package: str, sha: str, publisher: Optional[Publisher] = None) -> bool:
+    """ Build a package if outdated, with a publisher the manifest is only updated once it is published """
+    from builder.arch import pkgbuild
 
-def process(package: str, sha: str) -> bool:
     logger.info(f"Processing package: {package}")
     m = Manifest(MANIFEST_NAME)
     manifest = m.check(package)
     if manifest is None or manifest != sha:
         logger.info(f"Building package {package}")
+        before = artifact_mtimes()
         pkgs = pkgbuild.parse(package)
         for pkg in pkgs:
             process_dependency(package, pkg, pkgs)
-        system.execute(['makepkg', '-s', '-C', '--noconfirm', '--needed'],
-                       env=makepkg_env(), cwd=package)
-        m.update(package, sha)
-        logger.info(f"Package {package} updated")
+        # -f as the manifest already decided to rebuild, artifacts can still hold this version in the daemon
+        makepkg(['-s', '-f', '-C', '--noconfirm', '--needed'], pkgs[0].pkgbase, package)
+        if publisher is None:
+            m.update(package, sha)
+            logger.info(f"Package {package} updated")
+        else:
+            publisher.put(built_since(before), lambda: m.update(package, sha))
+            logger.info(f"Package {package} queued for publishing")
         return True
     else:
         logger.info(f"Package {package} up to date, not rebuilding")
         return False
 
 
-def build_main() -> None:
-    logger.info("Building packages")
-    system.update_keys()
+def update_packages() -> None:
+    system.update_packages(PACMAN_STAMP)
+    if PACMAN_CACHE_MAX_MB > 0:
+        system.clean_package_cache(PACMAN_CACHE_MAX_MB * 1024 * 1024)
+
+
+def use_keyring() -> None:
+    if KEYRING_DIR is not None:
+        system.use_keyring(KEYRING_DIR)
+
+
+def prepare_system() -> None:
+    use_keyring()
+    system.update_keys(KEYSERVER, KEYSERVER_TIMEOUT, KEY_REFRESH_DAYS)
     system.import_key(KEY_NAME, KEY_ID)
-    system.update_packages()
+    update_packages()
 
-    repo = Repo(Path.cwd())
+
+def refresh_system() -> None:
+    """ Pick up new keys and sync dbs between daemon cycles """
+    from builder.arch import repository_search
+
+    digest = system.syncdb_digest()
+    system.update_keys(KEYSERVER, KEYSERVER_TIMEOUT, KEY_REFRESH_DAYS)
+    update_packages()
+    if system.syncdb_digest() != digest:
+        logger.info("Sync databases changed, reloading alpm handle")
+        repository_search.reload_sync_dbs()
+
+
+def list_artifacts() -> set[str]:
+    return set(filter(lambda x: not x.endswith(".sig"),
+                      map(lambda x: os.path.basename(x),
+                          pathlib.Path('artifacts').glob('*.pkg.tar*'))))
+
+
+def artifact_mtimes() -> dict[str, float]:
+    return {package: os.path.getmtime(os.path.join('artifacts', package)) for package in list_artifacts()}
+
+
+def built_since(before: dict[str, float]) -> list[str]:
+    return sorted(package for package, mtime in artifact_mtimes().items() if before.get(package) != mtime)
+
+
+class Publisher:
+    """ Uploads packages and updates the repo db in the background while the build loop continues """
+
+    def __init__(self, commit_every: int = PUBLISH_EVERY):
+        self.commit_every = commit_every
+        self.queue: Queue[Optional[tuple[list[str], Callable[[], None]]]] = Queue()
+        self.failed = False
+        self.published: list[str] = []
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, packages: list[str], published: Callable[[], None]) -> None:
+        """ Queue the packages of one build, published is called once they are in the committed db """
+        self.queue.put((packages, published))
+
+    def close(self) -> None:
+        """ Publish everything queued so far and commit the db """
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self) -> None:
+        repo = None
+        pending: list[str] = []
+        callbacks: list[Callable[[], None]] = []
+        try:
+            while (item := self.queue.get()) is not None:
+                packages, published = item
+                # Skip this when doing local offline CI testing with act
+                if os.environ.get('ACT') is None:
+                    for package in packages:
+                        if repo is None:
+                            repo = S3Repo(REPO_NAME, BUCKET_NAME)
+                            repo.download()
+                        repo.add_package(package)
+                        pending.append(package)
+                callbacks.append(published)
+                if self.commit_every > 0 and len(pending) >= self.commit_every:
+                    self.commit(repo, pending)
+                    self.run_callbacks(callbacks)
+            if repo is not None and len(pending) > 0:
+                self.commit(repo, pending)
+            self.run_callbacks(callbacks)
+        except (Exception, SystemExit):
+            # system.execute exits on failure, that only ends this thread so flag it for the build loop.
+            # Packages not committed keep their old manifest entry and are rebuilt next run
+            logger.exception("Publishing failed")
+            self.failed = True
+
+    def commit(self, repo: S3Repo, pending: list[str]) -> None:
+        repo.upload()
+        upload_index(repo)
+        self.published += pending
+        pending.clear()
+
+    @staticmethod
+    def run_callbacks(callbacks: list[Callable[[], None]]) -> None:
+        for callback in callbacks:
+            callback()
+        callbacks.clear()
+
+
+def remove_artifacts(packages: list[str]) -> None:
+    for package in packages:
+        for file in [package, f"{package}.sig"]:
+            Path('artifacts', file).unlink(missing_ok=True)
+
+
+def build_submodules(repo: Repo, publisher: Optional[Publisher] = None) -> bool:
+    """ Build all outdated submodules, returns False when MAX_PER_BUILD was hit """
     builds = 0
     for submodule in repo.iter_submodules():
-        if process(submodule.path, submodule.hexsha):  # type: ignore
+        if publisher is not None and publisher.failed:
+            logger.error("Publishing failed, not building any more packages")
+            break
+        if process(submodule.path, submodule.hexsha, publisher):  # type: ignore
             builds += 1
         if builds >= MAX_PER_BUILD:
-            logger.info("Hit max builds per single run, please run again")
-            exit(0)
+            return False
+    return True
 
 
-def package_main() -> None:
-    packages = list(filter(lambda x: not x.endswith(".sig"),
-                           map(lambda x: os.path.basename(x),
-                               pathlib.Path('artifacts').glob('*.pkg.tar*'))))
+def build_main(pipeline: bool = False) -> None:
+    from git.repo import Repo
+
+    logger.info("Building packages")
+    prepare_system()
+
+    repo = Repo(Path.cwd())
+    publisher = Publisher() if pipeline else None
+    try:
+        complete = build_submodules(repo, publisher)
+    finally:
+        if publisher is not None:
+            publisher.close()
+    if publisher is not None and publisher.failed:
+        exit(100)
+    if not complete:
+        logger.info("Hit max builds per single run, please run again")
+        exit(0)
+
+
+def publish(packages: list[str]) -> None:
     logger.info(f"Found {len(packages)} packages to add to repo")
     if len(packages) > 0:
         # system.import_key(KEY_NAME, KEY_ID)
@@ -153,7 +350,81 @@ def package_main() -> None:
             upload_index(repo)
 
 
+def package_main() -> None:
+    publish(sorted(list_artifacts()))
+
+
+class TriggerHandler(BaseHTTPRequestHandler):
+    """ Accepts build requests for the daemon, any POST schedules a build """
+    trigger = Event()
+
+    def do_POST(self) -> None:
+        TriggerHandler.trigger.set()
+        self.send_response(202)
+        self.end_headers()
+
+    def log_message(self, format: str, *args) -> None:
+        logger.debug(f"{self.address_string()} - {format % args}")
+
+
+def sync_superproject(repo: Repo) -> None:
+    if repo.active_branch.tracking_branch() is not None:
+        logger.debug("Pulling superproject")
+        repo.git.pull('--ff-only')
+    repo.git.submodule('update', '--init')
+
+
+def serve_main() -> None:
+    """ Keep the system, alpm handle and manifest warm and build on new commits or requests """
+    from git.repo import Repo
+
+    repo = Repo(Path.cwd())
+    if repo.head.is_detached:
+        logger.error("Superproject HEAD is detached, check out the branch to follow before serving")
+        exit(-1)
+
+    logger.info(f"Serving build requests on {SERVE_ADDRESS}:{SERVE_PORT}")
+    # Keys and packages are updated by refresh_system at the start of each cycle
+    use_keyring()
+    system.import_key(KEY_NAME, KEY_ID)
+
+    server = ThreadingHTTPServer((SERVE_ADDRESS, SERVE_PORT), TriggerHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+
+    trigger = TriggerHandler.trigger
+    trigger.set()
+    last_head = None
+    while True:
+        trigger.wait(SERVE_INTERVAL)
+        requested = trigger.is_set()
+        trigger.clear()
+        try:
+            sync_superproject(repo)
+            head = repo.head.commit.hexsha
+            if head == last_head and not requested:
+                continue
+            logger.info(f"Building superproject at {head}")
+            refresh_system()
+            publisher = Publisher()
+            try:
+                if not build_submodules(repo, publisher):
+                    logger.info("Hit max builds per single run, continuing")
+                    trigger.set()
+            finally:
+                publisher.close()
+                # The daemon keeps its working tree, don't let artifacts pile up
+                remove_artifacts(publisher.published)
+            # Unpublished packages keep their manifest entry, retry them next cycle
+            if not publisher.failed:
+                last_head = head
+        except (Exception, SystemExit):
+            # system.execute exits on failure, keep the daemon alive and retry next cycle
+            logger.exception("Build cycle failed")
+
+
 def upload_index(repo: S3Repo) -> None:
+    from builder.arch.repository import Repository
+
     r = Repository(os.path.join("artifacts", f"{REPO_NAME}.db.tar.zst"))
 
     with open(os.path.join('artifacts', 'repoPackages.json'), 'w') as writer:
@@ -181,13 +452,17 @@ if __name__ == "__main__":
                         action='store_true')
     parser.add_argument('--package', help='update repo with latest packages',
                         action='store_true')
+    parser.add_argument('--pipeline', help='build latest packages and publish each one as soon as it is built',
+                        action='store_true')
     parser.add_argument('--render', help='render and upload an index.html for the repo',
                         action='store_true')
+    parser.add_argument('--serve', help='run as a daemon, building on new commits or requests',
+                        action='store_true')
     args = parser.parse_args()
     if args.build and args.package:
         print("Cowardly refusing to do both build and package")
         exit(-1)
-    elif (not args.build) and (not args.package) and (not args.render):
+    elif (not args.build) and (not args.package) and (not args.pipeline) and (not args.render) and (not args.serve):
         parser.print_help()
         exit(-1)
 
@@ -195,5 +470,9 @@ if __name__ == "__main__":
         build_main()
     elif args.package:
         package_main()
+    elif args.pipeline:
+        build_main(pipeline=True)
     elif args.render:
         render_main()
+    elif args.serve:
+        serve_main()
@@ -1,6 +1,5 @@
 from typing import Optional, Union
 
-import libarchive
 from pydantic import BaseModel
 
 from builder.arch.package_common import verdeps_dict, optdeps_dict
@@ -36,6 +35,8 @@ class Repository:
     """ Simple parser for the arch repository format """
 
     def __init__(self, name: str):
+        import libarchive
+
         self.name = name
         self.entries = {}
         with libarchive.Archive(self.name, 'r') as archive:
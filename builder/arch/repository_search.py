@@ -1,20 +1,31 @@
+from functools import cache
 from typing import Optional
 
-import pyalpm
-import requests
 from loguru import logger
-from pyalpm import Handle
 from pydantic import BaseModel
 
 from builder.arch.package_common import verdeps_dict, optdeps_dict
 from builder.util.misc import listify
 
-_alpm_handle = Handle('/', '/var/lib/pacman')
-_repos = [_alpm_handle.register_syncdb('core', pyalpm.SIG_DATABASE_OPTIONAL),
-          _alpm_handle.register_syncdb(
-              'community', pyalpm.SIG_DATABASE_OPTIONAL),
-          _alpm_handle.register_syncdb('extra', pyalpm.SIG_DATABASE_OPTIONAL),
-          _alpm_handle.register_syncdb('multilib', pyalpm.SIG_DATABASE_OPTIONAL)]
+
+@cache
+def _alpm_handle():
+    """ alpm handle, created on first lookup so importing this module stays cheap """
+    from pyalpm import Handle
+    return Handle('/', '/var/lib/pacman')
+
+
+@cache
+def _repos() -> list:
+    import pyalpm
+    return [_alpm_handle().register_syncdb(name, pyalpm.SIG_DATABASE_OPTIONAL)
+            for name in ['core', 'community', 'extra', 'multilib']]
+
+
+def reload_sync_dbs() -> None:
+    """ Drop the alpm handle so the next lookup sees refreshed sync dbs """
+    _repos.cache_clear()
+    _alpm_handle.cache_clear()
 
 
 class LocalPackage(BaseModel):
@@ -144,8 +155,8 @@ def local_search(package: str) -> Optional[LocalPackage]:
     """ Search for a package in the systems default repos """
 
     logger.debug(f"Looking up {package} locally")
-    for repo in _repos:
-        pkg: pyalpm.Package = repo.get_pkg(package)
+    for repo in _repos():
+        pkg = repo.get_pkg(package)
         if pkg is None:
             # It could be a provides, if so lets take the first
             pkgs = repo.search(f"^{package}$")
@@ -173,6 +184,7 @@ def local_search(package: str) -> Optional[LocalPackage]:
 
 def aur_search(package: str) -> Optional[AURPackage]:
     """ Search for a package on the AUR """
+    import requests
 
     logger.debug(f"Looking up {package} on the AUR")
     params = {'v': '5', 'type': 'info', 'arg': [package]}
@@ -0,0 +1,81 @@
+import json
+import os
+import shutil
+from typing import Optional
+
+from loguru import logger
+
+from builder.util import system
+
+
+class CompilerCache:
+    """ Opt-in ccache/sccache for makepkg with a cache directory per package base """
+    KINDS = ['ccache', 'sccache']
+
+    def __init__(self, kind: str, cache_dir: str, max_size: str, exclude_file: Optional[str] = None):
+        if kind not in CompilerCache.KINDS:
+            raise ValueError(f"Unsupported compiler cache {kind}, expected one of {CompilerCache.KINDS}")
+        self.kind = kind
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.exclude = []
+        if exclude_file is not None and os.path.isfile(exclude_file):
+            with open(exclude_file, 'r') as lines:
+                for line in lines.read().split("\n"):
+                    pkgbase = line.split('#')[0].strip()
+                    if pkgbase != "":
+                        self.exclude.append(pkgbase)
+        self.available = shutil.which(kind) is not None
+        if not self.available:
+            logger.warning(f"{kind} is not installed, building without a compiler cache")
+        elif kind == 'sccache':
+            logger.info("sccache only wraps rustc and CMake builds, use ccache to cache other C/C++ builds")
+
+    def enabled(self, pkgbase: str) -> bool:
+        return self.available and pkgbase not in self.exclude
+
+    def configure(self, pkgbase: str, env: dict[str, str]) -> None:
+        directory = os.path.join(self.cache_dir, pkgbase)
+        if self.kind == 'ccache':
+            env["PATH"] = f"/usr/lib/ccache/bin:{env['PATH']}"
+            env["CCACHE_DIR"] = directory
+            env["CCACHE_MAXSIZE"] = self.max_size
+        else:
+            env["RUSTC_WRAPPER"] = "sccache"
+            env["CMAKE_C_COMPILER_LAUNCHER"] = "sccache"
+            env["CMAKE_CXX_COMPILER_LAUNCHER"] = "sccache"
+            env["SCCACHE_DIR"] = directory
+            env["SCCACHE_CACHE_SIZE"] = self.max_size
+
+    def start(self, env: dict[str, str]) -> None:
+        if self.kind == 'ccache':
+            system.execute(['ccache', '--zero-stats'], env=env)
+        else:
+            # Starts a server bound to this package's SCCACHE_DIR, stopped again in stop
+            system.execute(['sccache', '--zero-stats'], env=env)
+
+    def report(self, pkgbase: str, env: dict[str, str]) -> None:
+        if self.kind == 'ccache':
+            stats = {}
+            for line in system.execute(['ccache', '--print-stats'], env=env).split("\n"):
+                kv = line.split('\t')
+                if len(kv) == 2:
+                    stats[kv[0]] = int(kv[1])
+            hits = stats.get('direct_cache_hit', 0) + stats.get('preprocessed_cache_hit', 0)
+            misses = stats.get('cache_miss', 0)
+        else:
+            stats = json.loads(system.execute(['sccache', '--show-stats', '--stats-format', 'json'], env=env))
+            hits = sum(stats['stats']['cache_hits']['counts'].values())
+            misses = sum(stats['stats']['cache_misses']['counts'].values())
+
+        total = hits + misses
+        if total == 0:
+            logger.info(f"{self.kind} for {pkgbase}: no compilations went through the cache")
+            return
+        rate = hits / total
+        logger.info(f"{self.kind} for {pkgbase}: {hits} hits, {misses} misses ({rate:.0%} hit rate)")
+
+    def stop(self, env: dict[str, str]) -> None:
+        """ Stop the sccache server so the next package doesn't reuse this package's cache """
+        if self.kind == 'sccache':
+            system.execute(['sccache', '--stop-server'], env=env)
@@ -1,6 +1,6 @@
 import os
+from functools import cached_property
 
-import boto3
 import mimetypes
 from loguru import logger
 
@@ -16,7 +16,11 @@ class S3Repo:
         self.repo_files = [str.join('.', [self.repo_name, 'db', compression]),
                            str.join('.', [self.repo_name, 'files', compression])]
 
-        self.s3 = boto3.client('s3')
+    @cached_property
+    def s3(self):
+        """ boto3 is slow to import, so the client is created on first use """
+        import boto3
+        return boto3.client('s3')
 
     def download(self) -> None:
         logger.info("Downloading repository files")
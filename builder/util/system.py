@@ -1,6 +1,9 @@
+import hashlib
 import io
 import os
-from subprocess import Popen, PIPE
+import time
+from pathlib import Path
+from subprocess import Popen, PIPE, TimeoutExpired
 from threading import Thread
 from io import StringIO
 from typing import Optional, Mapping
@@ -13,21 +16,114 @@ def update_arch_keyring() -> None:
     execute(['sudo', 'pacman', '-Sy', 'archlinux-keyring', '--noconfirm', '--needed'])
 
 
-def update_packages() -> None:
+def syncdb_digest(dbpath: str = '/var/lib/pacman') -> str:
+    digest = hashlib.sha256()
+    for db in sorted(Path(dbpath, 'sync').glob('*.db')):
+        digest.update(bytes(db.name, 'utf-8'))
+        digest.update(db.read_bytes())
+    return digest.hexdigest()
+
+
+def update_packages(stamp: Optional[str] = None) -> None:
+    """ Upgrade the system, when a stamp file is given skip the upgrade if the sync dbs are unchanged since """
+    if stamp is None:
+        logger.info("Updating system packages")
+        execute(['sudo', 'pacman', '-Syu', '--noconfirm', '--needed'])
+        return
+
+    execute(['sudo', 'pacman', '-Sy', '--noconfirm'])
+    digest = syncdb_digest()
+    if os.path.isfile(stamp) and Path(stamp).read_text().strip() == digest:
+        logger.info("Sync databases unchanged, skipping system upgrade")
+        return
     logger.info("Updating system packages")
-    execute(['sudo', 'pacman', '-Syu', '--noconfirm', '--needed'])
+    execute(['sudo', 'pacman', '-Su', '--noconfirm', '--needed'])
+    Path(stamp).parent.mkdir(parents=True, exist_ok=True)
+    Path(stamp).write_text(digest)
+
+
+def clean_package_cache(max_size: int, cache_dir: str = '/var/cache/pacman/pkg') -> None:
+    """ Keep only the latest version of each cached package, then drop the oldest until under max_size bytes """
+    logger.info("Cleaning package cache")
+    execute(['sudo', 'paccache', '-r', '-k', '1', '-c', cache_dir])
+    cache = Path(cache_dir)
+    # Partial downloads and signatures without a package are never used again
+    evict = [str(part) for part in cache.glob('*.part')]
+    evict += [str(sig) for sig in cache.glob('*.pkg.tar*.sig') if not sig.with_suffix('').is_file()]
+
+    packages = sorted(filter(lambda x: x.suffix not in ['.sig', '.part'], cache.glob('*.pkg.tar*')),
+                      key=lambda x: x.stat().st_mtime)
+    # A package is evicted together with its signature
+    groups = []
+    for package in packages:
+        sig = Path(f"{package}.sig")
+        groups.append([package, sig] if sig.is_file() else [package])
+    size = sum(file.stat().st_size for group in groups for file in group)
+    while size > max_size and len(groups) > 0:
+        for file in groups.pop(0):
+            size -= file.stat().st_size
+            evict.append(str(file))
+    if len(evict) > 0:
+        logger.info(f"Evicting {len(evict)} files from package cache")
+        execute(['sudo', 'rm', '-f'] + evict)
+
+
+def read_keys(filename: str) -> list[str]:
+    """ Key ids from a keys file, one per line with optional # comments """
+    keys = []
+    with open(filename, 'r') as lines:
+        for line in lines.read().split("\n"):
+            keypart = line.split('#')[0].strip()
+            if keypart != "":
+                keys.append(keypart.upper().removeprefix('0X').replace(' ', ''))
+    return keys
+
 
+def keyring_fingerprints() -> list[str]:
+    output = execute(['gpg', '--batch', '--list-keys', '--with-colons'])
+    fingerprints = []
+    for line in output.split("\n"):
+        fields = line.split(':')
+        if fields[0] == 'fpr' and len(fields) > 9:
+            fingerprints.append(fields[9].upper())
+    return fingerprints
 
-def update_keys() -> None:
+
+def missing_keys(keys: list[str], fingerprints: list[str]) -> list[str]:
+    """ Keys not in the keyring, key ids match the tail of a fingerprint """
+    return [key for key in keys if not any(fpr.endswith(key) for fpr in fingerprints)]
+
+
+def use_keyring(directory: str) -> None:
+    """ Point gpg, and everything run through execute, at a keyring that can be kept between runs """
+    Path(directory).mkdir(mode=0o700, parents=True, exist_ok=True)
+    os.chmod(directory, 0o700)
+    os.environ['GNUPGHOME'] = os.path.abspath(directory)
+
+
+def refresh_due(stamp: Path, days: int) -> bool:
+    return not stamp.is_file() or time.time() - stamp.stat().st_mtime > days * 24 * 60 * 60
+
+
+def update_keys(keyserver: str = 'keyserver.ubuntu.com', timeout: Optional[float] = None,
+                refresh_days: int = 0) -> None:
+    """ Fetch keys from keys.txt missing in the keyring, and refresh the others every refresh_days """
     update_arch_keyring()
     if os.path.isfile('keys.txt'):
         logger.info("Updating system keyring")
-        with open('keys.txt', 'r') as keys:
-            for key in keys.read().split("\n"):
-                if key.strip() != "":
-                    keypart = key.split('#')[0].strip()
-                    execute(['gpg', '--keyserver',
-                             'keyserver.ubuntu.com', '--recv-key', keypart])
+        keys = read_keys('keys.txt')
+        missing = missing_keys(keys, keyring_fingerprints())
+        if len(missing) > 0:
+            logger.info(f"Fetching {len(missing)} missing keys from {keyserver}")
+            execute(['gpg', '--batch', '--keyserver', keyserver, '--recv-keys'] + missing, timeout=timeout)
+
+        # Keys already in the keyring are not fetched again, refresh them now and then for new expiry dates and subkeys
+        present = [key for key in keys if key not in missing]
+        stamp = Path(os.environ.get('GNUPGHOME', os.path.expanduser('~/.gnupg')), 'aurei-refreshed')
+        if refresh_days > 0 and len(present) > 0 and refresh_due(stamp, refresh_days):
+            logger.info(f"Refreshing {len(present)} keys from {keyserver}")
+            execute(['gpg', '--batch', '--keyserver', keyserver, '--refresh-keys'] + present, timeout=timeout)
+            stamp.touch()
 
 
 def import_key(name: str, keyid: str) -> None:
@@ -57,16 +153,22 @@ def _tee(infile, *files):
     return t
 
 
-def execute(command: list[str], cwd: Optional[str] = None, env: Optional[Mapping[str, str]] = None) -> str:
+def execute(command: list[str], cwd: Optional[str] = None, env: Optional[Mapping[str, str]] = None,
+            timeout: Optional[float] = None) -> str:
     logger.debug(f"executing command: {command}")
     p = Popen(command, stdout=PIPE, stderr=PIPE, cwd=cwd, env=env, text=True)
     stout = StringIO()
     sterr = StringIO()
     threads = [_tee(p.stdout, stout, logger.debug),
                _tee(p.stderr, sterr, logger.error)]
+    try:
+        ret = p.wait(timeout=timeout)
+    except TimeoutExpired:
+        p.kill()
+        logger.error(f"command timed out after {timeout}s: {command}")
+        exit(100)
     for t in threads:
         t.join()
-    ret = p.wait()
     if ret != 0:
         logger.error(f"failed to execute command: {command} exit code {ret}")
         exit(100)